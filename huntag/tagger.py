@@ -23,7 +23,8 @@ class Tagger:
 
         if options['task'] not in {'print-weights', 'tag-featurize'}:
             print('loading transition model...', end='', file=sys.stderr, flush=True)
-            self._trans_probs = TransModel.load_from_file(options['transmodel_filename'])
+            self._trans_probs = TransModel.load_from_file(options['transmodel_filename'],
+                                                          options.get('beam_width'))
             print('done', file=sys.stderr, flush=True)
         else:
             self._trans_probs = None
@@ -34,6 +35,12 @@ class Tagger:
         self._label_counter = BookKeeper(options['labelcounter_filename'])
         print('done', file=sys.stderr, flush=True)
 
+        # The columns of the label probabilities in the order of the tags of the transition model
+        if self._trans_probs is not None:
+            self._trans_label_cols = [self._label_counter.get_no_tag(tag) for tag in self._trans_probs.tag_list]
+        else:
+            self._trans_label_cols = None
+
         # Set functions according to task...
         if options.get('inp_featurized', False):
             self._featurize_sentence_fun = use_featurized_sentence
@@ -57,8 +64,8 @@ class Tagger:
                 data.append(1)
         contexts = csr_matrix((data, (rows, cols)), shape=(len(feat_numbers), self._feat_counter.num_of_names()),
                               dtype=self._data_sizes['data_np'])
-        tagprobs_by_pos = [{self._label_counter.no_to_name[i]: prob for i, prob in enumerate(prob_dist)}
-                           for prob_dist in self._model.predict_proba(contexts)]
+        # One row for every position, one column for every tag of the transition model
+        tagprobs_by_pos = self._model.predict_proba(contexts)[:, self._trans_label_cols]
         return tagprobs_by_pos
 
     @staticmethod
@@ -88,30 +88,23 @@ def load_yaml(cfg_file):
         cfg_file = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', cfg_file))
     try:
         with open(cfg_file, encoding='UTF-8') as fh:
-            lines = fh.readlines()
+            # The leading newline lets the markers be searched as whole lines in the text read at once
+            text = '\n{0}'.format(fh.read())
     except FileNotFoundError:
         print('Error: Config file ({0}) not found!'.format(cfg_file), file=sys.stderr)
-        lines = ''
-        exit(1)
+        sys.exit(1)
 
-    try:
-        start = lines.index('%YAML 1.1\n')
-    except ValueError:
+    start = text.find('\n%YAML 1.1\n')
+    if start == -1:
         print('Error in config file: No document start marker found!', file=sys.stderr)
         sys.exit(1)
-    rev = lines[start:]
-    rev.reverse()
-    try:
-        end = rev.index('...\n')*(-1)
-    except ValueError:
+    start += 1
+    end = text.rfind('\n...\n', start)  # The last one
+    if end == -1:
         print('Error in config file: No document end marker found!', file=sys.stderr)
         sys.exit(1)
-    if end == 0:
-        lines = lines[start:]
-    else:
-        lines = lines[start:end]
 
-    return yaml.load(''.join(lines), Loader=yaml.SafeLoader)
+    return yaml.load(text[start:end + 1], Loader=yaml.SafeLoader)
 
 
 def get_featureset_yaml(cfg_file):
@@ -328,12 +328,11 @@ class Trainer:
         labels = self._labels
         beg = 0
         for end in sent_end:
-            for row in range(beg, end + 1):
-                print('{0}\t{1}'.format(labelno_to_name[labels[row]],
-                                        '\t'.join(featno_to_name[col].replace(':', 'colon')
-                                                  for col in matrix[row, :].nonzero()[1])),
-                      file=output_stream)
-            print(file=output_stream)  # Sentence separator blank line
+            # Write the sentence at once: one line for every token and the sentence separator blank line
+            output_stream.write(''.join('{0}\t{1}\n'.format(labelno_to_name[labels[row]],
+                                                            '\t'.join(featno_to_name[col].replace(':', 'colon')
+                                                                      for col in matrix[row, :].nonzero()[1]))
+                                        for row in range(beg, end + 1)) + '\n')
             beg = end + 1
 
     def train(self):
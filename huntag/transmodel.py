@@ -10,6 +10,16 @@ import sys
 import math
 import pickle
 from collections import Counter
+from itertools import chain
+import numpy as np
+try:
+    from numba import njit
+    from numba import from_dtype as numba_from_dtype
+except ImportError:
+    njit = None
+
+# The transition matrices and the emission logprobs of the Viterbi (max and argmax are exact in any precision)
+viterbi_dtype = np.float32
 
 
 def safe_div(v1, v2):
@@ -27,24 +37,176 @@ def safe_div(v1, v2):
         return float(v1) / float(v2)
 
 
+def _safe_div_arr(v1, v2):
+    """
+    safe_div() elementwise for arrays (or scalars) of counts
+    returns -1 where the denominator is 0
+
+    Args:
+        v1: numerators
+        v2: denominators
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(v2 != 0, np.true_divide(v1, v2), -1.0)
+
+
+def _viterbi_bigram_np(trans_matrix, e, start_row):
+    """
+    The recursion of the bigram Viterbi with NumPy operations (used when Numba is not available)
+    returns the backpointers and the scores of the states at the last position
+
+    Args:
+        trans_matrix: [n, n] transition logprobs between the states (weighted by the language model weight)
+        e: [T, n] emission logprobs
+        start_row: [n] transition logprobs from the sentence start (weighted by the language model weight)
+    """
+    seq_len, n = e.shape
+    bp = np.empty((seq_len, n), dtype=np.intp)  # bp[0] is never read
+
+    # Initialize base cases (t == 0)
+    # We can come only from boundary symbols, so there is no need for loop and max...
+    v = start_row + e[0]
+    # Only the scores of t-1 and t are needed: two rolling buffers (and one for the scores of the transitions)
+    v_new = np.empty_like(v)
+    scores = np.empty((n, n), dtype=v.dtype)
+
+    # Run Viterbi for t > 0
+    for t in range(1, seq_len):
+        # scores[y0, y]: In t-1 we stand at y0 and we extend the graph to every possible state y
+        np.add(v[:, None], trans_matrix, out=scores)
+        scores += e[t][None, :]
+        # To every possible states, we can only come from the maximum
+        # We remember this particular state
+        scores.argmax(axis=0, out=bp[t])
+        scores.max(axis=0, out=v_new)
+        v, v_new = v_new, v
+    return bp, v
+
+
+def _viterbi_bigram_loops(trans_matrix, e, start_row):
+    """
+    The same as _viterbi_bigram_np() with explicit loops to be compiled by Numba:
+    add, max and argmax are fused into one loop without temporary arrays
+    """
+    seq_len, n = e.shape
+    bp = np.empty((seq_len, n), dtype=np.int64)
+    v = start_row + e[0]
+    v_new = np.empty_like(v)
+    for t in range(1, seq_len):
+        for y in range(n):
+            best = -np.inf
+            best_y0 = 0
+            for y0 in range(n):
+                score = v[y0] + trans_matrix[y0, y]
+                if score > best:  # The first maximum wins as with argmax()
+                    best = score
+                    best_y0 = y0
+            v_new[y] = best + e[t, y]
+            bp[t, y] = best_y0
+        v, v_new = v_new, v
+    return bp, v
+
+
+def _viterbi_bigram_beam(trans_matrix, e, start_row, beam_width):
+    """
+    The same as _viterbi_bigram_np() but only the beam_width best states of t-1 can be the predecessors
+    of the states in t: O(beam_width * n) work for every step instead of O(n * n)
+    """
+    seq_len, n = e.shape
+    bp = np.empty((seq_len, n), dtype=np.int64)
+    state_idx = np.arange(n)
+    v = start_row + e[0]
+    for t in range(1, seq_len):
+        beam = np.argpartition(v, -beam_width)[-beam_width:]
+        # scores[k, y]: In t-1 we stand at beam[k] and we extend the graph to every possible state y
+        scores = v[beam, None] + trans_matrix[beam] + e[t][None, :]
+        best = scores.argmax(axis=0)
+        bp[t] = beam[best]
+        v = scores[best, state_idx]
+    return bp, v
+
+
+if njit is not None:
+    # fastmath without the no-inf/no-nan assumptions as log(0) == -inf can occur among the emissions
+    _viterbi_bigram_kernel = njit(cache=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'})(
+        _viterbi_bigram_loops)
+else:
+    _viterbi_bigram_kernel = _viterbi_bigram_np
+
+# Up to this number of states the bigram Viterbi kernel is generated for the exact number of states
+specialized_kernel_max_states = 64
+_specialized_kernels = {}
+
+
+def _specialized_viterbi_bigram_kernel(n):
+    """
+    Generate and compile a variant of _viterbi_bigram_loops() for exactly n states where the loop over
+    the predecessor states is unrolled (the compiler can keep the scores in registers and vectorize)
+    returns the generic kernel when Numba is not available or n is too large for unrolling
+
+    Args:
+        n: the number of states
+    """
+    if njit is None or n > specialized_kernel_max_states:
+        return _viterbi_bigram_kernel
+    kernel = _specialized_kernels.get(n)
+    if kernel is None:
+        lines = ['def kernel(trans_matrix, e, start_row):',
+                 '    seq_len = e.shape[0]',
+                 '    bp = np.empty((seq_len, {0}), dtype=np.int64)'.format(n),
+                 '    v = start_row + e[0]',
+                 '    v_new = np.empty_like(v)',
+                 '    for t in range(1, seq_len):',
+                 '        for y in range({0}):'.format(n),
+                 '            best = v[0] + trans_matrix[0, y]',
+                 '            best_y0 = 0']
+        for y0 in range(1, n):
+            lines.extend(('            score = v[{0}] + trans_matrix[{0}, y]'.format(y0),
+                          '            if score > best:',
+                          '                best = score',
+                          '                best_y0 = {0}'.format(y0)))
+        lines.extend(('            v_new[y] = best + e[t, y]',
+                      '            bp[t, y] = best_y0',
+                      '        v, v_new = v_new, v',
+                      '    return bp, v'))
+        namespace = {'np': np}
+        exec(compile('\n'.join(lines), '<viterbi_bigram_{0}>'.format(n), 'exec'), namespace)
+        # Compiled eagerly for the contiguous arrays of _build_trans_matrices() and _emission_logprobs()
+        matrix_type = numba_from_dtype(viterbi_dtype)[:, ::1]
+        vector_type = numba_from_dtype(viterbi_dtype)[::1]
+        kernel = njit((matrix_type, numba_from_dtype(viterbi_dtype)[:, :], vector_type),
+                      fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'})(namespace['kernel'])
+        _specialized_kernels[n] = kernel
+    return kernel
+
+
 # Bigram or Trigram transition model
 class TransModel:
     def __init__(self, source_fields=None, target_fields=None, smooth=0.000000000000001, boundary_symbol='S', lmw=1.0,
-                 order=3):
-        self._unigram_count = Counter()
-        self.unigram_logprob = {}
+                 order=3, beam_width=None):
+        self._tag_to_id = {}
+        self._id_to_tag = []
+        self._unigram_count = np.zeros(0, dtype=np.int64)
         self._lambda1 = 0.0
-        self._bigram_count = Counter()
-        self.bigram_logprob = {}
+        self._bigram_count = np.zeros((0, 0), dtype=np.int64)
         self._lambda2 = 0.0
         self._trigram_count = Counter()
-        self.trigram_logprob = {}
         self._lambda3 = 0.0
+        # The pickled counts of a loaded model, they are interned only when training resumes (see _resume_counts())
+        self._loaded_counts = None
+        # The logprob arrays are indexed by the tag ids at the time of the last compile() (or load)
+        # and they have one more index (self._unknown_idx) with smoothing for any other tag
+        self._tag_idx = {}
+        self._unknown_idx = 0
+        self._unigram_logprobs = np.zeros(1)
+        self._bigram_logprobs = np.zeros((1, 1))
+        # Only the seen trigrams are kept (keyed by (id1, id2, id3) as the counts), the others are smoothed
+        self._trigram_logprobs = {}
+        self.tag_list = []
         self._obs_count = 0
         self._sent_count = 0
         self.tags = set()
         self.updated = True
-        self.reset()
 
         # Field names for e-magyar TSV
         if source_fields is None:
@@ -58,8 +220,12 @@ class TransModel:
 
         self._log_smooth = math.log(float(smooth))
         self._boundary_symbol = boundary_symbol
+        self._boundary_id = None
+        self.reset()
         self._language_model_weight = float(lmw)
         self._order = int(order)
+        # Keep only the best beam_width predecessors in every Viterbi step (None: exact search)
+        self.beam_width = beam_width
         if self._order == 2:
             self.viterbi = self._viterbi_bigram
         elif self._order == 3:
@@ -71,13 +237,44 @@ class TransModel:
         self._update_warning = 'WARNING: Probabilities have not been recalculated since last input!'
 
     def reset(self):
-        self._unigram_count = Counter()
-        self._bigram_count = Counter()
+        # Tags are interned to ids which index the count arrays (the capacity is doubled when needed)
+        self._tag_to_id = {}
+        self._id_to_tag = []
+        self._unigram_count = np.zeros(8, dtype=np.int64)
+        self._bigram_count = np.zeros((8, 8), dtype=np.int64)
+        # Only a small fraction of the possible trigrams is seen: they are counted by (id1, id2, id3)
         self._trigram_count = Counter()
+        self._loaded_counts = None
+        self._boundary_id = self._tag_id(self._boundary_symbol)
         self._obs_count = 0
         self._sent_count = 0
         self.updated = True
 
+    def _tag_id(self, tag):
+        tag_id = self._tag_to_id.get(tag)
+        if tag_id is None:
+            tag_id = len(self._id_to_tag)
+            self._tag_to_id[tag] = tag_id
+            self._id_to_tag.append(tag)
+            if tag_id >= len(self._unigram_count):
+                self._grow_counts()
+        return tag_id
+
+    # Tagging needs only the logprobs, the count arrays of a loaded model are built when they are first needed
+    def _resume_counts(self):
+        if self._loaded_counts is not None:
+            loaded_counts, self._loaded_counts = self._loaded_counts, None
+            self._counts_from_counters(*loaded_counts)
+
+    def _grow_counts(self):
+        old_cap = len(self._unigram_count)
+        new_cap = 2 * old_cap
+        unigram_count = np.zeros(new_cap, dtype=np.int64)
+        unigram_count[:old_cap] = self._unigram_count
+        bigram_count = np.zeros((new_cap, new_cap), dtype=np.int64)
+        bigram_count[:old_cap, :old_cap] = self._bigram_count
+        self._unigram_count, self._bigram_count = unigram_count, bigram_count
+
     def prepare_fields(self, field_names):
         source_fields_len = len(self.source_fields)
         if source_fields_len != 1:
@@ -93,81 +290,114 @@ class TransModel:
         return [[]]  # Nothing to return just the model...
 
     # Tag a sentence given the probability dists. of words
+    # (a list of dicts keyed by tags or an array with one column for every tag in self.tag_list order)
     def tag_sent(self, tagprobs_by_pos):
         return self.viterbi(tagprobs_by_pos)[1]
 
+    # Make logprob from probs: one row for every position, one column for every state in self.tag_list order
+    def _emission_logprobs(self, tagprobs_by_pos):
+        if not isinstance(tagprobs_by_pos, np.ndarray):
+            tagprobs_by_pos = [[prob_dist[tag] for tag in self.tag_list] for prob_dist in tagprobs_by_pos]
+        # The log is taken in double precision as small probabilities would underflow in float32
+        return np.log(np.asarray(tagprobs_by_pos, dtype=float)).astype(viterbi_dtype)
+
     # Train a Sentence (Either way we count trigrams, but later we will not use them)
     def _obs_sequence(self, tag_sequence):
-        last_before = self._boundary_symbol
-        last = self._boundary_symbol
+        self._resume_counts()
+        # Intern the tags first as it may grow the count arrays
+        boundary_id = self._boundary_id
+        # XXX Maybe we should make explicit difference between sentence begin sentence end
+        ids = np.array([boundary_id, boundary_id] + [self._tag_id(tag) for tag in tag_sequence] + [boundary_id])
         # Add the two boundary symbol to the counts...
-        self._bigram_count[self._boundary_symbol, self._boundary_symbol] += 1
-        self._unigram_count[self._boundary_symbol] += 2
+        self._bigram_count[boundary_id, boundary_id] += 1
+        self._unigram_count[boundary_id] += 2
         self._obs_count += 2
         # Count sentences, for later normalization
         self._sent_count += 1
-        for tag in tag_sequence:
-            self.obs(last_before, last, tag)
-            last_before = last
-            last = tag
-        # XXX Maybe we should make explicit difference between sentence begin sentence end
-        self.obs(last_before, last, self._boundary_symbol)
+        # The same as calling self.obs(last_before, last, tag) for every tag and the closing boundary symbol
+        id_list = ids.tolist()
+        self._trigram_count.update(zip(id_list, id_list[1:], id_list[2:]))
+        np.add.at(self._bigram_count, (ids[1:-1], ids[2:]), 1)
+        np.add.at(self._unigram_count, ids[2:], 1)
+        self._obs_count += len(ids) - 2
+        self.updated = False
 
     # Train a Bigram or Trigram (Compute trigrams, and later optionally use bigrams only)
     # To train directly a bigram use: obs(nMinusOne=firstToken, nth=secondToken) or obs(None, firstToken, secondToken)
     def obs(self, n_minus_two=None, n_minus_one=None, nth=None):
-        self._trigram_count[n_minus_two, n_minus_one, nth] += 1
-        self._bigram_count[n_minus_one, nth] += 1
-        self._unigram_count[nth] += 1
+        self._resume_counts()
+        # Intern the tags first as it may grow the count arrays
+        i, j, k = self._tag_id(n_minus_two), self._tag_id(n_minus_one), self._tag_id(nth)
+        self._trigram_count[i, j, k] += 1
+        self._bigram_count[j, k] += 1
+        self._unigram_count[k] += 1
         self._obs_count += 1
         self.updated = False
 
     # Close model, and compute probabilities after (possibly incremental) training
     def compile(self):
-        self.trigram_logprob = {}
-        self.bigram_logprob = {}
-        self.unigram_logprob = {}
-
-        bigram_joint_logprob = {}
-        
+        self._resume_counts()
         if self._order == 2:
+            boundary_id = self._boundary_id
             # Remove (self._boundary_symbol, self._boundary_symbol) as it has no meaning for bigrams...
-            self._bigram_count.pop((self._boundary_symbol, self._boundary_symbol), None)
+            self._bigram_count[boundary_id, boundary_id] = 0
             # Remove the Unigram count of the removed self._boundary_symbol
-            self._unigram_count[self._boundary_symbol] -= self._sent_count
+            self._unigram_count[boundary_id] -= self._sent_count
             self._obs_count -= self._sent_count
             # Reset, as incremental training (if there is any) will start from here...
             self._sent_count = 0
 
-        # Compute unigram probs: P(t_n) = C(t_n)/sum_i(C(t_i))
-        self.tags = set(self._unigram_count.keys())
-        self.unigram_logprob = {tag: math.log(count) - math.log(self._obs_count)
-                                for tag, count in self._unigram_count.items()}
-
-        # Compute bigram probs (Conditional probability using joint probabilities):
-        # Unigram prob: P(t_n-1) = C(t_n)/sum_i(C(t_i)) = self.unigram_logprob[tag]
-        # Joint prob (bigram): P(t_n-1, t_n) = C(t_n-1, t_n)/C(t_n-1) = bigram_joint_logprob(tag1,tag2)
-        # Conditional prob (bigram): P(t_n|t_n-1) = P(t_n-1, t_n)/P(t_n-1) =
-        #     bigram_joint_logprob(tag1,tag2) - self.unigram_logprob[tag1]
-        for pair, count in self._bigram_count.items():  # log(Bigram / Unigram)
-            bigram_joint_logprob[pair] = math.log(count) - math.log(self._unigram_count[pair[0]])
-            self.bigram_logprob[pair] = bigram_joint_logprob[pair] - self.unigram_logprob[pair[0]]
-
-        if self._order == 3:
-            # Compute trigram probs (Conditional probability using joint probabilities):
+        n = len(self._id_to_tag)
+        unigram_count = self._unigram_count[:n]
+        bigram_count = self._bigram_count[:n, :n]
+        self.tags = {self._id_to_tag[i] for i in np.flatnonzero(unigram_count)}
+        self._tag_idx = dict(self._tag_to_id)
+
+        # The logs of the zero counts are masked with smoothing
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Compute unigram probs: P(t_n) = C(t_n)/sum_i(C(t_i))
+            log_unigram_count = np.log(unigram_count)
+            unigram_logprob = log_unigram_count - math.log(self._obs_count)
+            self._unigram_logprobs = np.where(unigram_count > 0, unigram_logprob, self._log_smooth)
+
+            # Compute bigram probs (Conditional probability using joint probabilities):
+            # Unigram prob: P(t_n-1) = C(t_n)/sum_i(C(t_i)) = unigram_logprob[tag]
             # Joint prob (bigram): P(t_n-1, t_n) = C(t_n-1, t_n)/C(t_n-1) = bigram_joint_logprob(tag1,tag2)
-            # Joint prob (trigram): P(t_n-2, t_n-1, t_n) = C(t_n-2, t_n-1, t_n)/C(t_n-2, t_n-1) =
-            #     trigram_joint_logprob(tag1, tag2, tag3)
-            # Conditional prob (trigram): P(t_n|t_n-2, t_n-1) = P(t_n-2, t_n-1, t_n)/P(t_n-2, t_n-1) =
-            #     trigram_joint_logprob(tag1, tag2, tag3) - bigram_joint_logprob(tag1, tag2)
-            for tri, count in self._trigram_count.items():  # log(Trigram / Bigram)
-                trigram_joint_logprob = math.log(count) - math.log(self._bigram_count[tri[0:2]])
-                self.trigram_logprob[tri] = trigram_joint_logprob - bigram_joint_logprob[tri[0:2]]
+            # Conditional prob (bigram): P(t_n|t_n-1) = P(t_n-1, t_n)/P(t_n-1) =
+            #     bigram_joint_logprob(tag1,tag2) - unigram_logprob[tag1]
+            log_bigram_count = np.log(bigram_count)
+            bigram_joint_logprob = log_bigram_count - log_unigram_count[:, None]  # log(Bigram / Unigram)
+            bigram_logprob = bigram_joint_logprob - unigram_logprob[:, None]
+            self._bigram_logprobs = np.where(bigram_count > 0, bigram_logprob, self._log_smooth)
+
+            if self._order == 3:
+                # Compute trigram probs (Conditional probability using joint probabilities):
+                # Joint prob (bigram): P(t_n-1, t_n) = C(t_n-1, t_n)/C(t_n-1) = bigram_joint_logprob(tag1,tag2)
+                # Joint prob (trigram): P(t_n-2, t_n-1, t_n) = C(t_n-2, t_n-1, t_n)/C(t_n-2, t_n-1) =
+                #     trigram_joint_logprob(tag1, tag2, tag3)
+                # Conditional prob (trigram): P(t_n|t_n-2, t_n-1) = P(t_n-2, t_n-1, t_n)/P(t_n-2, t_n-1) =
+                #     trigram_joint_logprob(tag1, tag2, tag3) - bigram_joint_logprob(tag1, tag2)
+                # Only for the seen trigrams, the others are smoothed
+                i, j, k = np.array(list(self._trigram_count), dtype=np.intp).reshape(-1, 3).T
+                trigram_count = np.fromiter(self._trigram_count.values(), dtype=np.int64,
+                                            count=len(self._trigram_count))
+                trigram_joint_logprob = np.log(trigram_count) - log_bigram_count[i, j]  # log(Trigram / Bigram)
+                trigram_logprob = trigram_joint_logprob - bigram_joint_logprob[i, j]
+                self._trigram_logprobs = dict(zip(self._trigram_count, trigram_logprob.tolist()))
+            else:
+                self._trigram_logprobs = {}  # Not computed for bigrams
+
+        # The last index is for the unknown tags
+        self._unknown_idx = n
+        self._unigram_logprobs, self._bigram_logprobs = \
+            (np.pad(logprob_arr, (0, 1), constant_values=self._log_smooth)
+             for logprob_arr in (self._unigram_logprobs, self._bigram_logprobs))
 
         # Compute lambdas
         self._compute_lambda()
 
         self.updated = True
+        self._build_trans_matrices()
 
     def _compute_lambda(self):
         """
@@ -190,57 +420,43 @@ class TransModel:
         by (f(t1,t2,t3) / 2)
         """
 
-        # temporary lambda variables
-        tl1 = 0.0
-        tl2 = 0.0
-        tl3 = 0.0
-
-        # for each t3 given t1,t2 in system
-        for h1, h2, tag in self._trigram_count.keys():
-
-            # if there has only been 1 occurrence of this tag in the data
-            # then ignore this trigram.
-            if self._unigram_count[tag] > 1:
+        # for each t3 given t1,t2 in system (all trigrams at once, the cases below are exclusive)
+        # if there has only been 1 occurrence of this tag in the data
+        # then ignore this trigram.
+        ids = np.array(list(self._trigram_count), dtype=np.intp).reshape(-1, 3)
+        count = np.fromiter(self._trigram_count.values(), dtype=np.int64, count=len(self._trigram_count))
+        seen = self._unigram_count[ids[:, 2]] > 1
+        h1, h2, tag = ids[seen].T
+        count = count[seen]
+
+        # _safe_div_arr provides a safe floating point division
+        # it returns -1 where the denominator is 0
+        if self._order == 3:
+            c3 = _safe_div_arr(count - 1, self._bigram_count[h1, h2] - 1)
+        else:
+            c3 = np.full(len(count), -2.0)  # Never will be maximum
+        c2 = _safe_div_arr(self._bigram_count[h2, tag] - 1, self._unigram_count[h2] - 1)
+        c1 = _safe_div_arr(self._unigram_count[tag] - 1, self._obs_count - 1)
+
+        # if c1 is the maximum value:
+        only_c1 = (c1 > c3) & (c1 > c2)
+        # if c2 is the maximum value
+        only_c2 = (c2 > c3) & (c2 > c1)
+        # if c3 is the maximum value
+        only_c3 = (c3 > c2) & (c3 > c1)
+        # if c3, and c2 are equal and larger than c1
+        c2_c3 = (c3 == c2) & (c3 > c1)
+        # if c1, and c2 are equal and larger than c3
+        # this might be a dumb thing to do....(not sure yet)
+        c1_c2 = (c2 == c1) & (c1 > c3)
+        # otherwise there might be a problem (eg: all values = 0), the trigram is not counted
+
+        # temporary lambda variables (the sums of the counts and the half counts are exact in float)
+        half_count = count / 2.0
+        tl1 = float(count[only_c1].sum() + half_count[c1_c2].sum())
+        tl2 = float(count[only_c2].sum() + half_count[c2_c3].sum() + half_count[c1_c2].sum())
+        tl3 = float(count[only_c3].sum() + half_count[c2_c3].sum())
 
-                # safe_div provides a safe floating point division
-                # it returns -1 if the denominator is 0
-                if self._order == 3:
-                    c3 = safe_div(self._trigram_count[h1, h2, tag] - 1, self._bigram_count[h1, h2] - 1)
-                else:
-                    c3 = -2.0  # Never will be maximum
-                c2 = safe_div(self._bigram_count[h2, tag] - 1, self._unigram_count[h2] - 1)
-                c1 = safe_div(self._unigram_count[tag] - 1, self._obs_count - 1)
-
-                # if c1 is the maximum value:
-                if (c1 > c3) and (c1 > c2):
-                    tl1 += self._trigram_count[h1, h2, tag]
-
-                # if c2 is the maximum value
-                elif (c2 > c3) and (c2 > c1):
-                    tl2 += self._trigram_count[h1, h2, tag]
-
-                # if c3 is the maximum value
-                elif (c3 > c2) and (c3 > c1):
-                    tl3 += self._trigram_count[h1, h2, tag]
-
-                # if c3, and c2 are equal and larger than c1
-                elif (c3 == c2) and (c3 > c1):
-                    tl2 += self._trigram_count[h1, h2, tag] / 2.0
-                    tl3 += self._trigram_count[h1, h2, tag] / 2.0
-
-                # if c1, and c2 are equal and larger than c3
-                # this might be a dumb thing to do....(not sure yet)
-                elif (c2 == c1) and (c1 > c3):
-                    tl1 += self._trigram_count[h1, h2, tag] / 2.0
-                    tl2 += self._trigram_count[h1, h2, tag] / 2.0
-
-                """
-                # otherwise there might be a problem
-                # eg: all values = 0
-                else:
-                    print('Problem', c1, c2 ,c3)
-                    pass
-                """
         # Lambda normalisation:
         # ensures that l1+l2+l3 = 1
         self._lambda1 = tl1 / (tl1 + tl2 + tl3)
@@ -254,14 +470,19 @@ class TransModel:
         if not self.updated:
             print(self._update_warning, file=sys.stderr, flush=True)
 
-        # Trigram, which is seen in training set or using smoothing
-        tri = self.trigram_logprob.get((n_minus_two, n_minus_one, nth), self._log_smooth)
+        # Unknown tags get the index of smoothing
+        i = self._tag_idx.get(n_minus_two, self._unknown_idx)
+        j = self._tag_idx.get(n_minus_one, self._unknown_idx)
+        k = self._tag_idx.get(nth, self._unknown_idx)
+
+        # Unigram, which is seen in training set or using smoothing (the arrays are prefilled with smoothing)
+        uni = self._unigram_logprobs[k]
 
         # Bigram, which is seen in training set or using smoothing
-        bi = self.bigram_logprob.get((n_minus_one, nth), self._log_smooth)
+        bi = self._bigram_logprobs[j, k]
 
-        # Unigram, which is seen in training set or using smoothing
-        uni = self.unigram_logprob.get(nth, self._log_smooth)
+        # Trigram, which is seen in training set or using smoothing
+        tri = self._trigram_logprobs.get((i, j, k), self._log_smooth)
 
         # Weighted by lambdas...
         return self._lambda1 * uni + self._lambda2 * bi + self._lambda3 * tri
@@ -270,11 +491,26 @@ class TransModel:
         return math.exp(self._log_prob(n_minus_two, n_minus_one, nth))
 
     def save_to_file(self, file_name):
+        self._resume_counts()
         self.tags.remove(self._boundary_symbol)
 
-        obs = ((self._unigram_count, self.unigram_logprob, self._lambda1),
-               (self._bigram_count, self.bigram_logprob , self._lambda2),
-               (self._trigram_count, self.trigram_logprob, self._lambda3))
+        # The counts and the logprobs are saved as Counters and dicts keyed by tags (tuples of tags)
+        # to keep the format of the model file
+        n = len(self._tag_idx)
+        id_to_tag = self._id_to_tag
+        if self._order == 3:
+            # The trigrams of the tags which are newer than the logprobs are not computed
+            trigram_logprob = {(id_to_tag[i], id_to_tag[j], id_to_tag[k]):
+                               self._trigram_logprobs.get((i, j, k), self._log_smooth)
+                               for i, j, k in self._trigram_count if i < n and j < n and k < n}
+        else:
+            trigram_logprob = {}  # Not computed for bigrams
+        obs = ((self._count_arr_to_counter(self._unigram_count),
+                self._logprob_arr_to_dict(self._unigram_logprobs, self._unigram_count[:n]), self._lambda1),
+               (self._count_arr_to_counter(self._bigram_count),
+                self._logprob_arr_to_dict(self._bigram_logprobs, self._bigram_count[:n, :n]), self._lambda2),
+               (Counter({(id_to_tag[i], id_to_tag[j], id_to_tag[k]): count
+                         for (i, j, k), count in self._trigram_count.items()}), trigram_logprob, self._lambda3))
         rest = (self._obs_count, self._sent_count, self.tags, self.updated, self.source_fields, self.target_fields)
         params = (self._log_smooth, self._boundary_symbol, self._language_model_weight, self._order)
 
@@ -282,13 +518,18 @@ class TransModel:
             pickle.dump((obs, rest, params), f)
 
     @staticmethod
-    def load_from_file(file_name):
+    def load_from_file(file_name, beam_width=None):
         with open(file_name, 'rb') as f:
             obs, rest, params = pickle.load(f)
-            m = TransModel()
-            m._unigram_count, m.unigram_logprob, m._lambda1 = obs[0]
-            m._bigram_count, m.bigram_logprob, m._lambda2 = obs[1]
-            m._trigram_count, m.trigram_logprob, m._lambda3 = obs[2]
+            m = TransModel(boundary_symbol=params[1], beam_width=beam_width)
+            unigram_count, unigram_logprob, m._lambda1 = obs[0]
+            bigram_count, bigram_logprob, m._lambda2 = obs[1]
+            trigram_count, trigram_logprob, m._lambda3 = obs[2]
+            m._loaded_counts = (unigram_count, bigram_count, trigram_count)
+            # The tags get the same ids as the ones _counts_from_counters() will give them when training resumes
+            m._tag_idx = dict(m._tag_to_id)
+            for tag in m._tags_of_counts(unigram_count, bigram_count, trigram_count):
+                m._tag_idx.setdefault(tag, len(m._tag_idx))
             m._obs_count, m._sent_count, m.tags, m.updated, m.source_fields, m.target_fields = rest
             m._log_smooth, m._boundary_symbol, m._language_model_weight, m._order = params
 
@@ -301,12 +542,126 @@ class TransModel:
                       flush=True)
                 sys.exit(1)
 
+            m._logprobs_from_dicts(unigram_logprob, bigram_logprob, trigram_logprob)
+            m._build_trans_matrices()
             return m
 
+    def _count_arr_to_counter(self, count_arr):
+        id_to_tag = self._id_to_tag
+        if count_arr.ndim == 1:
+            return Counter({id_to_tag[i]: int(count_arr[i]) for i in np.flatnonzero(count_arr)})
+        return Counter({tuple(id_to_tag[i] for i in ids): int(count_arr[ids]) for ids in zip(*np.nonzero(count_arr))})
+
+    def _counts_from_counters(self, unigram_count, bigram_count, trigram_count):
+        # Intern every tag first as it may grow the count arrays
+        for tag in self._tags_of_counts(unigram_count, bigram_count, trigram_count):
+            self._tag_id(tag)
+        for counts, count_arr in ((unigram_count, self._unigram_count), (bigram_count, self._bigram_count)):
+            if len(counts) > 0:
+                count_arr[self._ngram_ids(counts, self._tag_to_id)] = \
+                    np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+        tag_to_id = self._tag_to_id
+        self._trigram_count = Counter({(tag_to_id[tag1], tag_to_id[tag2], tag_to_id[tag3]): count
+                                       for (tag1, tag2, tag3), count in trigram_count.items()})
+
+    @staticmethod
+    def _tags_of_counts(unigram_count, bigram_count, trigram_count):
+        return chain(unigram_count, chain.from_iterable(bigram_count), chain.from_iterable(trigram_count))
+
+    def _logprob_arr_to_dict(self, logprob_arr, count_arr):
+        tags_by_id = list(self._tag_idx)
+        if logprob_arr.ndim == 1:
+            return {tags_by_id[i]: float(logprob_arr[i]) for i in np.flatnonzero(count_arr)}
+        return {tuple(tags_by_id[i] for i in ids): float(logprob_arr[ids]) for ids in zip(*np.nonzero(count_arr))}
+
+    def _logprobs_from_dicts(self, unigram_logprob, bigram_logprob, trigram_logprob):
+        n = len(self._tag_idx)
+        # Unseen n-grams keep the smoothing value, the last index is for the unknown tags
+        self._unknown_idx = n
+        self._unigram_logprobs = np.full(n + 1, self._log_smooth)
+        self._bigram_logprobs = np.full((n + 1, n + 1), self._log_smooth)
+        for logprobs, logprob_arr in ((unigram_logprob, self._unigram_logprobs),
+                                      (bigram_logprob, self._bigram_logprobs)):
+            if len(logprobs) > 0:
+                logprob_arr[self._ngram_ids(logprobs, self._tag_idx)] = \
+                    np.fromiter(logprobs.values(), dtype=float, count=len(logprobs))
+        tag_idx = self._tag_idx
+        self._trigram_logprobs = {(tag_idx[tag1], tag_idx[tag2], tag_idx[tag3]): logprob
+                                  for (tag1, tag2, tag3), logprob in trigram_logprob.items()}
+
+    @staticmethod
+    def _ngram_ids(ngrams, tag_to_id):
+        """
+        Map the keys of a dict keyed by tags (or tuples of tags) to index arrays (one for every dimension)
+        to fill a dense array with the values of the dict in one step
+        """
+        ids = np.array([[tag_to_id[tag] for tag in ngram] if isinstance(ngram, tuple) else [tag_to_id[ngram]]
+                        for ngram in ngrams])
+        return tuple(ids.T)
+
+    # Transition matrices for the vectorized Viterbi (the boundary symbol is not a state)
+    # All transitions used inside the recursion are weighted by the language model weight here once
+    def _build_trans_matrices(self):
+        self.tag_list = sorted(self.tags - {self._boundary_symbol})
+        n = len(self.tag_list)
+        # The states in self.tag_list order, the boundary symbol gets the last index
+        ids = np.array([self._tag_idx[tag] for tag in self.tag_list + [self._boundary_symbol]])
+        unigram_logprobs = self._unigram_logprobs[ids]
+        bigram_logprobs = self._bigram_logprobs[np.ix_(ids, ids)]
+
+        # trans_matrix[i, j] = logprob(tag_j | tag_i) = self._log_prob(None, tag_i, tag_j)
+        # The trigram can only be smoothed as it starts with None
+        trans_matrix = (self._lambda1 * unigram_logprobs[None, :] + self._lambda2 * bigram_logprobs +
+                        self._lambda3 * self._log_smooth)
+        lmw = self._language_model_weight
+        self._trans_matrix = np.ascontiguousarray(lmw * trans_matrix[:n, :n], dtype=viterbi_dtype)
+        # Transitions from the sentence start and to the sentence end (the latter is not weighted)
+        self._start_row = np.ascontiguousarray(lmw * trans_matrix[n, :n], dtype=viterbi_dtype)
+        self._end_col = np.ascontiguousarray(trans_matrix[:n, n], dtype=viterbi_dtype)
+        # The number of states is fixed from now on, the kernel for it is compiled at the first _viterbi_bigram() call
+        self._viterbi_bigram_kernel = None
+        # The trigram tensors are O(n^3), they are built at the first _viterbi_trigram() call (not for training)
+        self._trigram_trans_tensor = None
+
+    # The trigram transition tensors of the states in viterbi_dtype (the only O(n^3) arrays of the model)
+    def _build_trigram_trans(self):
+        n = len(self.tag_list)
+        # The states in self.tag_list order, the boundary symbol gets the last index
+        ids = np.array([self._tag_idx[tag] for tag in self.tag_list + [self._boundary_symbol]])
+        lmw = self._language_model_weight
+
+        # trigram_trans[i, j, k] = logprob(tag_k | tag_i, tag_j) = self._log_prob(tag_i, tag_j, tag_k)
+        # It is trans_matrix[j, k] for the unseen trigrams: only the seen ones are computed and scattered
+        self._trigram_trans_tensor = np.empty((n, n, n), dtype=viterbi_dtype)
+        self._trigram_trans_tensor[:] = self._trans_matrix[None, :, :]
+        # Transitions from the two boundary symbols (t == 0) and from one boundary symbol (t == 1)
+        self._trigram_start_row = self._start_row.copy()
+        self._trigram_start_matrix = self._trans_matrix.copy()
+        if len(self._trigram_logprobs) == 0:
+            return
+
+        # The seen trigrams in states (the boundary symbol is n, the tags which are not states are dropped)
+        state_of_idx = np.full(len(self._tag_idx) + 1, -1)
+        state_of_idx[ids] = np.arange(n + 1)
+        idx = np.array(list(self._trigram_logprobs), dtype=np.intp).reshape(-1, 3).T
+        i, j, k = state_of_idx[idx]
+        trigram_logprobs = np.fromiter(self._trigram_logprobs.values(), dtype=float, count=len(self._trigram_logprobs))
+        seen = (i >= 0) & (j >= 0) & (k >= 0) & (k < n)  # The transitions to the boundary symbol are not used
+        i, j, k, idx, trigram_logprobs = i[seen], j[seen], k[seen], idx[:, seen], trigram_logprobs[seen]
+        trigram_trans = lmw * (self._lambda1 * self._unigram_logprobs[idx[2]] +
+                               self._lambda2 * self._bigram_logprobs[idx[1], idx[2]] +
+                               self._lambda3 * trigram_logprobs)
+        in_sent = (i < n) & (j < n)
+        self._trigram_trans_tensor[i[in_sent], j[in_sent], k[in_sent]] = trigram_trans[in_sent]
+        from_start = (i == n) & (j == n)
+        self._trigram_start_row[k[from_start]] = trigram_trans[from_start]
+        after_start = (i == n) & (j < n)
+        self._trigram_start_matrix[j[after_start], k[after_start]] = trigram_trans[after_start]
+
     """
     source: http://en.wikipedia.org/wiki/Viterbi_algorithm
     The code has been modified to match our Bigram models:
-    - models are dictionaries with tuples as keys
+    - models are dense arrays indexed by the position of the tags in self.tag_list
     - starting probabilities are not separate and end probabilities are also
     taken into consideration
     - transProbs should be a Bigram instance
@@ -316,111 +671,90 @@ class TransModel:
     """
     def _viterbi_bigram(self, tagprobs_by_pos):
         # Make logprob from probs...
-        tagprobs_by_pos = [dict([(key, math.log(val))
-                                 for key, val in probDist.items()])
-                           for probDist in tagprobs_by_pos]
-        v = [{}]
-        path = {}
-        states = self.tags
-
-        # Initialize base cases (t == 0)
-        for y in states:
-            v[0][y] = (self._language_model_weight *
-                       # We can come only from boundary symbols, so there is no need for loop and max...
-                       # We must remember len(states) piece of states
-                       self._log_prob(None, self._boundary_symbol, y) +
-                       tagprobs_by_pos[0][y])
-            path[y] = [y]
-
-        # Run Viterbi for t > 0
-        for t in range(1, len(tagprobs_by_pos)):
-            v.append({})
-            newpath = {}
-            # We extend the graph to every possible states
-            # To every possible states, we can only come from the maximum
-            # We remember this particular state
-            for y in states:
-                # In t-1 we stand at y0 with some specific probability but we only could come from the maximum
-                (prob, state) = max([(v[t - 1][y0] +
-                                      self._language_model_weight *
-                                      # If we come from (z, y0)
-                                      self._log_prob(None, y0, y) +
-                                      # If we extend, we get this
-                                      tagprobs_by_pos[t][y],
-                                      # This is the history, that we check
-                                      # We compute max by y0
-                                      y0) for y0 in states])
-                # Now we stand at y, because it has the maximal probability 'prob'
-                v[t][y] = prob
-                # Extending the path with y, we came from state 'state'
-                newpath[y] = path[state] + [y]
-
-            # Don't need to remember the old paths
-            path = newpath
+        tag_list = self.tag_list
+        e = self._emission_logprobs(tagprobs_by_pos)
+        if self._use_beam():
+            bp, v_last = _viterbi_bigram_beam(self._trans_matrix, e, self._start_row, self.beam_width)
+        else:
+            if self._viterbi_bigram_kernel is None:
+                self._viterbi_bigram_kernel = _specialized_viterbi_bigram_kernel(len(tag_list))
+            bp, v_last = self._viterbi_bigram_kernel(self._trans_matrix, e, self._start_row)
 
         # At the end of the text we do a multiplication with a transition to check
         # 'If we were in the end, would we come this way or not?'...
-        (prob, state) = max([(v[len(tagprobs_by_pos) - 1][y] + self._log_prob(None, y, self._boundary_symbol), y)
-                             for y in states])
-        return prob, path[state]
+        final = v_last + self._end_col
+        state = int(final.argmax())
+        prob = float(final[state])
+
+        # Follow the backpointers from the last state
+        path = [state]
+        for t in range(len(e) - 1, 0, -1):
+            state = bp[t, state]
+            path.append(state)
+        path.reverse()
+        return prob, [tag_list[i] for i in path]
 
     def _viterbi_trigram(self, tag_probs_by_pos):
         # Make logprob from probs...
-        tag_probs_by_pos = [dict([(key, math.log(val))
-                                  for key, val in probDist.items()])
-                            for probDist in tag_probs_by_pos]
-        v = [{}]
-        path = {}
-        states = self.tags
-
-        # Initialize base cases (t == 0)
-        for z in states:
-            for y in states:
-                v[0][z, y] = (self._language_model_weight *
-                              self._log_prob(self._boundary_symbol, self._boundary_symbol, y) +
-                              tag_probs_by_pos[0][y])
-                path[z, y] = [y]
-
-        if len(tag_probs_by_pos) > 1:
-            # Run Viterbi for t == 1
-            v.append({})
-            newpath = {}
-
-            for z in states:
-                for y in states:
-                    (prob, state) = max([(v[0][y0, z] +
-                                          self._language_model_weight *
-                                          self._log_prob(self._boundary_symbol, z, y) +
-                                          tag_probs_by_pos[1][y],
-                                          y0) for y0 in states])
-                    v[1][z, y] = prob
-                    newpath[z, y] = path[state, z] + [y]
-
-            # Don't need to remember the old paths
-            path = newpath
+        tag_list = self.tag_list
+        e = self._emission_logprobs(tag_probs_by_pos)
+        seq_len, n = e.shape
+        if self._trigram_trans_tensor is None:
+            self._build_trigram_trans()
+        # v[z, y]: we stand at y in t and came from z in t-1
+        # Only the scores of t-1 and t are needed: two rolling buffers
+        v = np.empty((n, n), dtype=viterbi_dtype)
+        v_new = np.empty_like(v)
+        # bp[t, z, y]: the best y0 in t-2 if we stand at (z, y) (bp[0] and bp[1] are never used)
+        bp = np.empty((seq_len, n, n), dtype=np.intp)
+
+        # Initialize base cases (t == 0), z is arbitrary as we can come only from boundary symbols
+        v[:] = self._trigram_start_row[None, :] + e[0][None, :]
+
+        if seq_len > 1:
+            # Run Viterbi for t == 1, where y0 is the boundary symbol (v[y0, z] is the same for all y0)
+            v_new[:] = v[0][:, None] + self._trigram_start_matrix + e[1][None, :]
+            v, v_new = v_new, v
 
             # Run Viterbi for t > 1
-            for t in range(2, len(tag_probs_by_pos)):
-                v.append({})
-                newpath = {}
-
-                for z in states:
-                    for y in states:
-                        (prob, state) = max([(v[t - 1][y0, z] +
-                                              self._language_model_weight *
-                                              self._log_prob(y0, z, y) +
-                                              tag_probs_by_pos[t][y],
-                                              y0) for y0 in states])
-                        v[t][z, y] = prob
-                        newpath[z, y] = path[state, z] + [y]
-
-                # Don't need to remember the old paths
-                path = newpath
+            z_idx, y_idx = np.indices((n, n))
+            scores = np.empty((n, n, n), dtype=viterbi_dtype)
+            use_beam = self._use_beam()
+            for t in range(2, seq_len):
+                if use_beam:
+                    # For every z only the beam_width best y0 can be the predecessors: beam[k, z] = y0
+                    beam = np.argpartition(v, -self.beam_width, axis=0)[-self.beam_width:]
+                    # beam_scores[k, z, y]: In t-1 we stand at (beam[k, z], z) and we extend the graph to (z, y)
+                    beam_scores = (np.take_along_axis(v, beam, axis=0)[:, :, None] +
+                                   self._trigram_trans_tensor[beam, np.arange(n)[None, :]] + e[t][None, None, :])
+                    best = beam_scores.argmax(axis=0)
+                    bp[t] = beam[best, z_idx]
+                    v_new[:] = beam_scores[best, z_idx, y_idx]
+                else:
+                    # scores[y0, z, y]: In t-1 we stand at (y0, z) and we extend the graph to (z, y)
+                    np.add(v[:, :, None], self._trigram_trans_tensor, out=scores)
+                    scores += e[t][None, None, :]
+                    scores.argmax(axis=0, out=bp[t])
+                    scores.max(axis=0, out=v_new)
+                v, v_new = v_new, v
 
         # Micro-optimalization: Brants (2000) say self._log_prob(None, y, self._boundary_symbol),
         # but why not self._log_prob(z, y, self._boundary_symbol) ?
-        (prob, state, state2) = max([(v[len(tag_probs_by_pos) - 1][z, y] +
-                                      # self._log_prob(z, y, self._boundary_symbol), z, y)
-                                      self._log_prob(None, y, self._boundary_symbol), z, y)
-                                     for z in states for y in states])
-        return prob, path[state, state2]
+        final = v + self._end_col[None, :]
+        z, y = np.unravel_index(int(final.argmax()), final.shape)
+        prob = float(final[z, y])
+
+        # Follow the backpointers from the last state: (z, y) in t comes from (bp[t, z, y], z) in t-1
+        path = [y]
+        for t in range(seq_len - 1, 1, -1):
+            path.append(z)
+            z, y = bp[t, z, y], z
+        # In t == 1 we stand at (z, y) where z is the first state (z is arbitrary in t == 0)
+        if seq_len > 1:
+            path.append(z)
+        path.reverse()
+        return prob, [tag_list[i] for i in path]
+
+    # Beam search is used only if it prunes anything
+    def _use_beam(self):
+        return self.beam_width is not None and 0 < self.beam_width < len(self.tag_list)
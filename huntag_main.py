@@ -5,6 +5,7 @@ import os
 import sys
 import argparse
 from os import mkdir
+from concurrent.futures import ProcessPoolExecutor
 from os.path import isdir, join, isfile
 
 from xtsv.tsvhandler import process
@@ -13,13 +14,41 @@ from huntag.tagger import Tagger
 from huntag.transmodel import TransModel
 
 
+def tag_file(inp_dir, out_dir, fn, tagger):
+    print('processing file {0}...'.format(fn), end='', file=sys.stderr, flush=True)
+    with open(os.path.join(inp_dir, fn), encoding='UTF-8') as ifh,\
+            open(join(out_dir, '{0}.tagged'.format(fn)), 'w', encoding='UTF-8', buffering=1 << 20) as ofh:
+                # The file is opened once and its sentences are flushed in large chunks
+                ofh.writelines(process(ifh, tagger))
+
+
 def tag_dir(io_dirs, tagger):
     inp_dir, out_dir = io_dirs
     for fn in os.listdir(inp_dir):
-        print('processing file {0}...'.format(fn), end='', file=sys.stderr, flush=True)
-        with open(os.path.join(inp_dir, fn), encoding='UTF-8') as ifh,\
-                open(join(out_dir, '{0}.tagged'.format(fn)), 'w', encoding='UTF-8') as ofh:
-                    ofh.writelines(process(ifh, tagger))
+        tag_file(inp_dir, out_dir, fn, tagger)
+
+
+worker_tagger = None  # Every worker process of tag_dir_parallel() loads its own tagger
+
+
+def init_tag_worker(options):
+    global worker_tagger
+    worker_tagger = Tagger(options, target_fields=[options['label_tag_field']])
+
+
+def tag_file_in_worker(inp_out_fn):
+    tag_file(*inp_out_fn, worker_tagger)
+
+
+def tag_dir_parallel(io_dirs, options):
+    inp_dir, out_dir = io_dirs
+    # The streams of the main process can not be passed to the workers
+    worker_options = {k: v for k, v in options.items() if k not in {'input_stream', 'output_stream'}}
+    with ProcessPoolExecutor(max_workers=options['jobs'], initializer=init_tag_worker,
+                             initargs=(worker_options,)) as pool:
+        # Exhaust the iterator to get the exceptions of the workers (if any)
+        for _ in pool.map(tag_file_in_worker, ((inp_dir, out_dir, fn) for fn in os.listdir(inp_dir))):
+            pass
 
 
 def valid_dir(input_dir):
@@ -76,6 +105,10 @@ def parse_args():
                         help='set relative weight of the language model to L',
                         metavar='L')
 
+    parser.add_argument('--beam-width', dest='beam_width', type=int, default=None,
+                        help='keep only the best N predecessors in every Viterbi step (default: exact search)',
+                        metavar='N')
+
     parser.add_argument('-O', '--cutoff', dest='cutoff', type=int, default=1,
                         help='set global cutoff to C',
                         metavar='C')
@@ -121,6 +154,11 @@ def parse_args():
                          help='process all files in DIR (instead of stdin)',
                          metavar='DIR')
 
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='tag the files of the input directory in N parallel processes '
+                             '(0 means the number of CPUs, every process loads the models)',
+                        metavar='N')
+
     options = parser.parse_args()
 
     # Put together model filenames...
@@ -145,6 +183,17 @@ def parse_args():
               flush=True)
         sys.exit(1)
 
+    if options.beam_width is not None and options.beam_width < 1:
+        print('Error: Beam width must be a positive integer!', file=sys.stderr, flush=True)
+        sys.exit(1)
+
+    if options.jobs < 0:
+        print('Error: The number of jobs must be a non-negative integer!', file=sys.stderr, flush=True)
+        sys.exit(1)
+
+    if options.jobs == 0:
+        options.jobs = os.cpu_count()
+
     return vars(options)
 
 
@@ -183,15 +232,18 @@ def main():
 
     elif options['task'] in {'tag', 'print-weights', 'tag-featurize'}:  # TAG
 
-        tagger = Tagger(options, target_fields=[options['label_tag_field']])
-
-        if options['io_dirs'] is not None:  # Tag all files in a directory file to to filename.tagged
-            tag_dir(options['io_dirs'], tagger)
-        elif options['task'] == 'print-weights':  # Print MaxEnt weights to output stream
-            tagger.print_weights(options['output_stream'], options['num_weights'])
-        else:  # Tag a featurized or unfeaturized file or write the featurized format to to output_stream
-            options['output_stream'].writelines(process(options['input_stream'], tagger))
-            options['output_stream'].flush()
+        if options['io_dirs'] is not None and options['jobs'] > 1:  # Same as tag_dir() with a tagger in every worker
+            tag_dir_parallel(options['io_dirs'], options)
+        else:
+            tagger = Tagger(options, target_fields=[options['label_tag_field']])
+
+            if options['io_dirs'] is not None:  # Tag all files in a directory file to to filename.tagged
+                tag_dir(options['io_dirs'], tagger)
+            elif options['task'] == 'print-weights':  # Print MaxEnt weights to output stream
+                tagger.print_weights(options['output_stream'], options['num_weights'])
+            else:  # Tag a featurized or unfeaturized file or write the featurized format to to output_stream
+                options['output_stream'].writelines(process(options['input_stream'], tagger))
+                options['output_stream'].flush()
 
     else:  # Will never happen because argparse...
         print('Error: Task name must be specified! Please see --help!', file=sys.stderr, flush=True)